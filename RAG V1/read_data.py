@@ -1,14 +1,14 @@
 import sqlite3
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import torch
+from vector import load_embedding_model, EMBEDDING_MODEL_NAME
 
-def get_relevant_chunks(query: str, db_path: str, model_name: str = "all-mpnet-base-v2", top_k: int = 10):
+def get_relevant_chunks(query: str, db_path: str, model_name: str = EMBEDDING_MODEL_NAME, top_k: int = 10):
     """Retrieves the most relevant text chunks from the vector database based on the query."""
     
-    # Load the embedding model
-    model = SentenceTransformer(model_name, device="cuda")
+    # Reuse the embedding model loaded for ingestion
+    model = load_embedding_model(model_name)
     query_embedding = model.encode([query])[0]
     
     # Connect to the SQLite database
@@ -88,9 +88,10 @@ def generate_response(query: str, top_chunks: list, model_name: str = "google/ge
     return response
 
 # Example usage
-db_path = "embeddings.db"
-query = ""
-top_chunks = get_relevant_chunks(query, db_path)
-response = generate_response(query, top_chunks)
+if __name__ == "__main__":
+    db_path = "embeddings.db"
+    query = ""
+    top_chunks = get_relevant_chunks(query, db_path)
+    response = generate_response(query, top_chunks)
 
-print("Generated Response:\n", response)
+    print("Generated Response:\n", response)
@@ -1,5 +1,6 @@
 import os
 import sqlite3
+import hashlib
 import fitz  # PyMuPDF
 from sentence_transformers import SentenceTransformer
 import re
@@ -7,6 +8,20 @@ from tqdm.auto import tqdm
 
 MAX_CHUNK_SIZE = 384
 BATCH_SIZE = 32  # Adjust based on your GPU memory
+EMBEDDING_MODEL_NAME = "all-mpnet-base-v2"
+
+_embedding_models = {}
+
+def load_embedding_model(model_name: str = EMBEDDING_MODEL_NAME, device: str = "cuda") -> SentenceTransformer:
+    """Loads an embedding model once and reuses it for ingestion and querying."""
+    key = (model_name, device)
+    if key not in _embedding_models:
+        _embedding_models[key] = SentenceTransformer(model_name_or_path=model_name, device=device)
+    return _embedding_models[key]
+
+def chunk_hash(page_number: int, chunk_text: str) -> str:
+    """Hashes a chunk so duplicates can be found without comparing full text."""
+    return hashlib.sha1(f"{page_number}\x00{chunk_text}".encode("utf-8")).hexdigest()
 
 def text_formatter(text: str) -> str:
     """Performs minor formatting on text."""
@@ -55,13 +70,8 @@ def open_and_read_pdf(pdf_path: str) -> list[dict]:
         })
     return pages_and_texts
 
-def process_pdf_files(directory: str, db_path: str):
-    """Processes all PDF files in a directory and stores embeddings in an SQLite database."""
-    embedding_model = SentenceTransformer(model_name_or_path="all-mpnet-base-v2", device="cuda")
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
+def create_embeddings_table(cursor):
+    """Creates the embeddings table and upgrades older tables with a chunk hash column."""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS embeddings (
             id INTEGER PRIMARY KEY,
@@ -69,31 +79,54 @@ def process_pdf_files(directory: str, db_path: str):
             page_number INTEGER,
             chunk_text TEXT,
             embedding BLOB,
+            chunk_hash TEXT,
             UNIQUE(file_name, page_number, chunk_text)
         )
     ''')
 
+    # Older databases were created without chunk_hash, backfill it once
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(embeddings)")]
+    if "chunk_hash" not in columns:
+        cursor.execute("ALTER TABLE embeddings ADD COLUMN chunk_hash TEXT")
+        rows = cursor.execute("SELECT id, page_number, chunk_text FROM embeddings").fetchall()
+        cursor.executemany(
+            "UPDATE embeddings SET chunk_hash = ? WHERE id = ?",
+            [(chunk_hash(page_number, chunk_text), row_id) for row_id, page_number, chunk_text in rows]
+        )
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_file_hash ON embeddings (file_name, chunk_hash)")
+
+def process_pdf_files(directory: str, db_path: str):
+    """Processes all PDF files in a directory and stores embeddings in an SQLite database."""
+    embedding_model = load_embedding_model()
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    create_embeddings_table(cursor)
+    conn.commit()
+
     pdf_files = [f for f in os.listdir(directory) if f.endswith(".pdf")]
 
     for file_name in tqdm(pdf_files, desc="Processing PDF files"):
         pdf_path = os.path.join(directory, file_name)
         pages_and_texts = open_and_read_pdf(pdf_path)
 
-        all_chunks = []
+        # Fetch every stored hash for this file in one query
+        cursor.execute("SELECT chunk_hash FROM embeddings WHERE file_name = ?", (file_name,))
+        seen_hashes = {row[0] for row in cursor.fetchall()}
+
+        # Check for duplicates before embedding
+        unique_chunks = []
         for item in pages_and_texts:
             for sentence_chunk in item["sentence_chunks"]:
                 chunk_text = " ".join(sentence_chunk).replace("  ", " ").strip()
                 chunk_text = re.sub(r'\.([A-Z])', r'. \1', chunk_text)
-                all_chunks.append((file_name, item["page_number"], chunk_text))
-
-        # Check for duplicates before embedding
-        unique_chunks = []
-        for chunk in all_chunks:
-            cursor.execute('''
-                SELECT 1 FROM embeddings WHERE file_name = ? AND page_number = ? AND chunk_text = ?
-            ''', (chunk[0], chunk[1], chunk[2]))
-            if cursor.fetchone() is None:
-                unique_chunks.append(chunk)
+                hashed = chunk_hash(item["page_number"], chunk_text)
+                if hashed in seen_hashes:
+                    continue
+                seen_hashes.add(hashed)
+                unique_chunks.append((file_name, item["page_number"], chunk_text, hashed))
 
         # Batch process embeddings
         for i in range(0, len(unique_chunks), BATCH_SIZE):
@@ -101,16 +134,18 @@ def process_pdf_files(directory: str, db_path: str):
             texts = [chunk[2] for chunk in batch]
             embeddings = embedding_model.encode(texts, batch_size=BATCH_SIZE)
 
-            for chunk, embedding in zip(batch, embeddings):
-                cursor.execute('''
-                    INSERT OR IGNORE INTO embeddings (file_name, page_number, chunk_text, embedding)
-                    VALUES (?, ?, ?, ?)
-                ''', (chunk[0], chunk[1], chunk[2], embedding.tobytes()))
+            cursor.executemany('''
+                INSERT OR IGNORE INTO embeddings (file_name, page_number, chunk_text, embedding, chunk_hash)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(chunk[0], chunk[1], chunk[2], embedding.tobytes(), chunk[3]) for chunk, embedding in zip(batch, embeddings)])
+
+        # Commit per file so progress survives an interrupted run
+        conn.commit()
 
-    conn.commit()
     conn.close()
 
 # Example usage
-directory = "data"
-db_path = "embeddings.db"
-process_pdf_files(directory, db_path)
+if __name__ == "__main__":
+    directory = "data"
+    db_path = "embeddings.db"
+    process_pdf_files(directory, db_path)
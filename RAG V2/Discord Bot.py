@@ -1,3 +1,4 @@
+import asyncio
 import discord
 from discord import app_commands
 import interphase
@@ -24,6 +25,27 @@ embed_url = "<your URL2>"
 embed_model = "<your embed Model>"
 
 memory_of_convo = []
+memory_generation = 0  # Bumped on clear so a running compaction doesn't bring old memory back
+compaction_task = None
+
+max_prompt_tokens = 131072  # you will need to update this to the model your usings context window
+memory_compact_threshold = 4096  # tokens of memory before older turns are folded into a summary
+memory_keep_recent = 4  # turns always kept word for word
+
+
+async def compact_memory_in_background():
+    """Fold older turns into the running summary between requests."""
+    global memory_of_convo
+    generation = memory_generation
+    snapshot = list(memory_of_convo)
+
+    compacted = await asyncio.to_thread(
+        interphase.compact_memory, api_url, model, snapshot, memory_keep_recent, memory_compact_threshold
+    )
+
+    # Keep turns that arrived while the summary was being written
+    if generation == memory_generation:
+        memory_of_convo = compacted + memory_of_convo[len(snapshot):]
 
 
 @client.event
@@ -40,8 +62,9 @@ async def ping(interaction: discord.Interaction):
 
 @tree.command(name="clear_memory", description="Clears The Bots Memory")
 async def ping(interaction: discord.Interaction):
-    global memory_of_convo
+    global memory_of_convo, memory_generation
     memory_of_convo = []
+    memory_generation += 1
     await interaction.response.send_message("Memory Cleared.")
 
 
@@ -54,7 +77,7 @@ async def ping(interaction: discord.Interaction):
 
 @tree.command(name="query", description="Ask the bot a question")
 async def query(interaction: discord.Interaction, user_query: str):
-    global memory_of_convo
+    global memory_of_convo, compaction_task
 
     if user_query:
         await interaction.response.defer(thinking=True)  # Defer response to indicate processing
@@ -62,12 +85,12 @@ async def query(interaction: discord.Interaction, user_query: str):
         # Retrieve relevant context from the database
         rag_item = interphase.SearchDataEmbed.search_and_return_results(db_name, user_query, embed_url, embed_model, 3)
 
-                # Ensure memory stays within token limits
-        while interphase.count_tokens(str(memory_of_convo)) > 131072: #you will need to update this to the model your usings context window
-            memory_of_convo.pop(0)  # Forget the oldest memory entry
+        # Generate AI response with current memory, trimmed so the prompt stays within the context window
+        response, memory_of_convo = interphase.query_ai_system(api_url, user_query, model, rag_item, memory_of_convo, max_prompt_tokens)
 
-        # Generate AI response with current memory
-        response, memory_of_convo = interphase.query_ai_system(api_url, user_query, model, rag_item, memory_of_convo)
+        # Summarize older turns after answering so the next prompt stays small
+        if compaction_task is None or compaction_task.done():
+            compaction_task = asyncio.create_task(compact_memory_in_background())
 
         try:
             # Craft full message before splitting
@@ -108,4 +131,7 @@ async def query(interaction: discord.Interaction, user_query: str):
 
 
 
+# Create or upgrade the database before serving, searches never migrate it themselves
+interphase.database_commands.create_database(db_name)
+
 client.run('<your Bot Token>')
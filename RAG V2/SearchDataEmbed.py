@@ -1,13 +1,35 @@
 import sqlite3
 import numpy as np
-import requests
 import os  # Import the database functions
+import heapq
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import database_commands
+import Vector_v2
+
+logger = logging.getLogger("SearchDataEmbed")
+
+# Bits of the per-book state bitmap kept by the search index
+BOOK_EXISTS = 1
+BOOK_EXCLUDED = 2
+BOOK_FOCUSED = 4
+
+_search_indexes = {}
+_load_locks = {}
+_index_lock = threading.Lock()
+
+# Per database (reduced_dim, method, rerank_factor) for the first scoring pass
+_reduced_settings = {}
+PCA_FIT_SAMPLE_SIZE = 20000
 
 def get_query_embedding(query: str, url_of_api: str, model_name: str):
     """Get the embedding vector for a given query string."""
     data = {"model": model_name, "prompt": query}
-    response = requests.post(url_of_api, json=data)
-    
+    response = Vector_v2.session.post(url_of_api, json=data)
+
     if response.status_code == 200:
         return np.array(response.json().get("embedding", []), dtype=np.float32)
     else:
@@ -19,61 +41,398 @@ def cosine_similarity(vec1, vec2):
         return -1  # Return low score for invalid vectors
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
-def find_similar_pages(db_name: str, query: str, url_of_api: str, model_name: str, top_n: int = 10, focus_only: bool = False):
+def _to_datetime64(value):
+    """Convert a datetime or a 'YYYY-MM-DD[ HH:MM:SS]' string to numpy datetime64."""
+    if isinstance(value, datetime):
+        return np.datetime64(value, 's')
+    return np.datetime64(str(value).strip().replace(' ', 'T'), 's')
+
+def _load_book_state(cursor):
+    """Build the book-state bitmap and date array, indexed by book id."""
+    books = cursor.execute("SELECT id, excluded, focused, date_added FROM books").fetchall()
+    size = max([book[0] for book in books], default=0) + 1
+
+    book_state = np.zeros(size, dtype=np.uint8)
+    book_dates = np.full(size, np.datetime64('NaT'), dtype='datetime64[s]')
+    for book_id, excluded, focused, date_added in books:
+        book_state[book_id] = BOOK_EXISTS | (BOOK_EXCLUDED if excluded else 0) | (BOOK_FOCUSED if focused else 0)
+        try:
+            book_dates[book_id] = _to_datetime64(date_added)
+        except ValueError:
+            pass  # Leave unparseable dates as NaT, they never match a date filter
+
+    return book_state, book_dates
+
+def _database_lock(key: str):
+    """Per database lock, so one thread loads or refreshes an index while the others wait for it."""
+    with _index_lock:
+        return _load_locks.setdefault(key, threading.Lock())
+
+def _read_page_rows(cursor, after_page_id: int = 0):
+    """Read (page id, book id, page number, embedding) for pages with an id above after_page_id."""
+    return cursor.execute("""
+    SELECT p.id, p.book_id, p.page_number, e.embedding
+    FROM page_embeddings e
+    JOIN pages p ON p.id = e.page_id
+    WHERE e.page_id > ?
+    ORDER BY e.page_id
+    """, (after_page_id,)).fetchall()
+
+def _page_signature(cursor):
+    """(count, highest id) of stored embeddings, page ids only grow so an append keeps the old rows."""
+    return tuple(cursor.execute("SELECT COUNT(*), COALESCE(MAX(page_id), 0) FROM page_embeddings").fetchone())
+
+def _rows_to_arrays(rows, dimension: int):
+    """Turn page rows into id arrays and a normalized embedding matrix, dropping vectors of another dimension."""
+    vectors = [np.frombuffer(row[3], dtype=np.float32) for row in rows]
+    keep = [i for i, vector in enumerate(vectors) if dimension and len(vector) == dimension and np.any(vector)]
+
+    embeddings = np.vstack([vectors[i] for i in keep]) if keep else np.zeros((0, dimension), dtype=np.float32)
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    return {
+        "page_ids": np.array([rows[i][0] for i in keep], dtype=np.int64),
+        "book_ids": np.array([rows[i][1] for i in keep], dtype=np.int64),
+        "page_numbers": np.array([rows[i][2] for i in keep], dtype=np.int64),
+        "embeddings": embeddings.astype(np.float32),
+    }
+
+def _build_search_index(db_name: str):
+    """Read every page embedding and the book flags of a database."""
+    database_commands.require_current_schema(db_name)  # Migrations run at startup, never from a search
+
+    # The connection is kept with the index, its data_version tells when any process wrote to the file
+    conn = sqlite3.connect(db_name, isolation_level=None, check_same_thread=False)
+    cursor = conn.cursor()
+    data_version = cursor.execute("PRAGMA data_version").fetchone()[0]
+
+    cursor.execute("BEGIN")  # One snapshot for pages and books
+    rows = _read_page_rows(cursor)
+    signature = _page_signature(cursor)
+    book_state, book_dates = _load_book_state(cursor)
+    cursor.execute("COMMIT")
+
+    # Only keep vectors of the dominant dimension, a mismatched vector can't be scored
+    dimension = Counter(len(row[3]) // 4 for row in rows if row[3]).most_common(1)
+    dimension = dimension[0][0] if dimension else 0
+
+    index = _rows_to_arrays(rows, dimension)
+    index.update(
+        book_state=book_state,
+        book_dates=book_dates,
+        dimension=dimension,
+        conn=conn,
+        data_version=data_version,
+        signature=signature,
+    )
+    return index
+
+def _refresh_search_index(index: dict):
+    """Bring a cached index up to date with the file.
+
+    Returns the same index when nothing was written, a copy with new book flags and
+    appended pages after inserts, or None when pages were removed and a full reload is needed.
+    """
+    cursor = index["conn"].cursor()
+    data_version = cursor.execute("PRAGMA data_version").fetchone()[0]
+    if data_version == index["data_version"]:
+        return index
+
+    cursor.execute("BEGIN")
+    signature = _page_signature(cursor)
+    book_state, book_dates = _load_book_state(cursor)
+    old_count, old_max_id = index["signature"]
+    rows = _read_page_rows(cursor, old_max_id) if signature != index["signature"] else []
+    cursor.execute("COMMIT")
+
+    if old_count + len(rows) != signature[0] or (rows and not index["dimension"]):
+        return None
+
+    refreshed = dict(index, book_state=book_state, book_dates=book_dates, data_version=data_version, signature=signature)
+    if not rows:
+        return refreshed
+
+    # New pages are appended, reduced views are extended with their existing projection
+    added = _rows_to_arrays(rows, index["dimension"])
+    for name in ("page_ids", "book_ids", "page_numbers", "embeddings"):
+        refreshed[name] = np.concatenate([index[name], added[name]])
+    refreshed["reduced"] = {
+        key: dict(projection, embeddings=np.vstack([projection["embeddings"], _project_rows(projection, added["embeddings"])]))
+        for key, projection in index.get("reduced", {}).items()
+    }
+    return refreshed
+
+def load_search_index(db_name: str):
+    """Load the page embeddings and book flags of a database into memory, cached per database.
+
+    The cached copy is checked against the file on every call, so writes from other processes show up too.
+    """
+    key = os.path.abspath(db_name)
+    with _database_lock(key):
+        with _index_lock:
+            index = _search_indexes.get(key)
+
+        if index is not None:
+            try:
+                refreshed = _refresh_search_index(index)
+            except sqlite3.Error:
+                refreshed = None  # Reload from scratch on a fresh connection
+            if refreshed is None:
+                index["conn"].close()
+            else:
+                if refreshed is not index:
+                    with _index_lock:
+                        _search_indexes[key] = refreshed
+                return refreshed
+
+        if not os.path.exists(db_name):
+            return None
+
+        index = _build_search_index(db_name)
+        with _index_lock:
+            _search_indexes[key] = index
+        return index
+
+def invalidate_search_index(db_name: str):
+    """Drop the cached index of a database so the next search reloads it."""
+    key = os.path.abspath(db_name)
+    with _database_lock(key):
+        with _index_lock:
+            index = _search_indexes.pop(key, None)
+        if index is not None:
+            index["conn"].close()
+
+def update_book_state(db_name: str, book_id: int, excluded: bool = None, focused: bool = None):
+    """Flip book flags in a cached index without reloading it."""
+    with _index_lock:
+        index = _search_indexes.get(os.path.abspath(db_name))
+    if index is None:
+        return
+
+    book_state = index["book_state"]
+    if book_id >= len(book_state) or not book_state[book_id] & BOOK_EXISTS:
+        invalidate_search_index(db_name)  # Book unknown to the index, reload on next search
+        return
+
+    state = int(book_state[book_id])
+    if excluded is not None:
+        state = (state | BOOK_EXCLUDED) if excluded else (state & ~BOOK_EXCLUDED)
+    if focused is not None:
+        state = (state | BOOK_FOCUSED) if focused else (state & ~BOOK_FOCUSED)
+    book_state[book_id] = state
+
+def _on_database_change(db_name: str, book_id: int = None, flags: dict = None):
+    """Keep cached indexes in sync with writes made through database_commands."""
+    if flags is None or book_id is None:
+        invalidate_search_index(db_name)
+    else:
+        update_book_state(db_name, book_id, flags.get("excluded"), flags.get("focused"))
+
+database_commands.change_listeners.append(_on_database_change)
+
+def build_page_mask(index: dict, focus_only: bool = False, book_ids: list = None, date_from=None, date_to=None, page_range: tuple = None):
+    """Build the boolean mask of index rows that pass the book flags and the optional filters."""
+    state = index["book_state"][index["book_ids"]]
+    mask = (state & BOOK_EXISTS).astype(bool) & ~(state & BOOK_EXCLUDED).astype(bool)
+
+    if focus_only:
+        mask &= (state & BOOK_FOCUSED).astype(bool)
+
+    if book_ids is not None:
+        mask &= np.isin(index["book_ids"], np.asarray(list(book_ids), dtype=np.int64))
+
+    if date_from is not None or date_to is not None:
+        dates = index["book_dates"][index["book_ids"]]
+        if date_from is not None:
+            mask &= dates >= _to_datetime64(date_from)
+        if date_to is not None:
+            mask &= dates <= _to_datetime64(date_to)
+
+    # page_range is (first_page, last_page), both inclusive, either side may be None
+    if page_range is not None:
+        first_page, last_page = page_range
+        if first_page is not None:
+            mask &= index["page_numbers"] >= first_page
+        if last_page is not None:
+            mask &= index["page_numbers"] <= last_page
+
+    return mask
+
+def fit_reduced_projection(index: dict, reduced_dim: int, method: str = "pca"):
+    """Fit (and cache on the index) a low dimension view of the stored embeddings.
+
+    "pca" projects onto the leading principal components, "truncate" keeps the
+    first reduced_dim values, which suits Matryoshka-trained embedding models.
+    """
+    cache = index.setdefault("reduced", {})
+    if (method, reduced_dim) in cache:
+        return cache[(method, reduced_dim)]
+
+    embeddings = index["embeddings"]
+    if method == "pca":
+        # Fit on a sample, the leading components settle long before the full corpus
+        sample = embeddings
+        if len(sample) > PCA_FIT_SAMPLE_SIZE:
+            sample = sample[np.random.default_rng(0).choice(len(sample), PCA_FIT_SAMPLE_SIZE, replace=False)]
+        mean = sample.mean(axis=0)
+        _, _, components = np.linalg.svd(sample - mean, full_matrices=False)
+        components = components[:reduced_dim].T.astype(np.float32)
+    elif method == "truncate":
+        mean, components = None, None
+    else:
+        raise ValueError(f"Unknown reduction method: {method}")
+
+    projection = {"method": method, "dimension": reduced_dim, "mean": mean, "components": components}
+    projection["embeddings"] = _project_rows(projection, embeddings)
+    cache[(method, reduced_dim)] = projection
+    return projection
+
+def _project_rows(projection: dict, embeddings):
+    """Project normalized embeddings into a reduced space and normalize them again."""
+    if projection["method"] == "pca":
+        reduced = (embeddings - projection["mean"]) @ projection["components"]
+    else:
+        reduced = embeddings[:, :projection["dimension"]]
+
+    norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (reduced / norms).astype(np.float32)
+
+def project_query(projection: dict, query_unit):
+    """Project a normalized query vector into a reduced space."""
+    if projection["method"] == "pca":
+        reduced = (query_unit - projection["mean"]) @ projection["components"]
+    else:
+        reduced = query_unit[:projection["embeddings"].shape[1]]
+    norm = np.linalg.norm(reduced)
+    return reduced / norm if norm else reduced
+
+def _top_rows(rows, scores, top_n: int):
+    """Return the rows with the top N scores, highest first."""
+    if rows.size > top_n:
+        best = np.argpartition(-scores, top_n)[:top_n]
+        rows, scores = rows[best], scores[best]
+    order = np.argsort(-scores)
+    return rows[order], scores[order]
+
+def _rank_rows(index: dict, rows, query_unit, top_n: int, settings: tuple = None):
+    """Rank candidate rows with full vectors, shortlisting them in a reduced space first when configured."""
+    if settings is not None:
+        reduced_dim, method, rerank_factor = settings
+        if reduced_dim < index["embeddings"].shape[1]:
+            projection = fit_reduced_projection(index, reduced_dim, method)
+            coarse = projection["embeddings"][rows] @ project_query(projection, query_unit)
+            rows, _ = _top_rows(rows, coarse, top_n * rerank_factor)
+
+    return _top_rows(rows, index["embeddings"][rows] @ query_unit, top_n)
+
+def measure_reduced_recall(db_name: str, reduced_dim: int, method: str = "pca", rerank_factor: int = 10, top_n: int = 10, sample_size: int = 100):
+    """Measure recall@top_n of reduced-dimension search against full-dimension search, using stored pages as queries.
+
+    Each sample page is left out of the rows it is ranked against, otherwise it would always find itself in both rankings.
+    """
+    index = load_search_index(db_name)
+    if index is None or len(index["embeddings"]) < 2:
+        return None
+
+    embeddings = index["embeddings"]
+    all_rows = np.arange(len(embeddings))
+    queries = np.random.default_rng(0).choice(len(embeddings), min(sample_size, len(embeddings)), replace=False)
+    expected = min(top_n, len(embeddings) - 1)
+
+    hits = 0
+    for query_row in queries:
+        rows = all_rows[all_rows != query_row]
+        exact, _ = _rank_rows(index, rows, embeddings[query_row], top_n)
+        approximate, _ = _rank_rows(index, rows, embeddings[query_row], top_n, (reduced_dim, method, rerank_factor))
+        hits += len(np.intersect1d(exact, approximate))
+
+    return hits / (len(queries) * expected)
+
+def enable_reduced_search(db_name: str, reduced_dim: int, method: str = "pca", rerank_factor: int = 10, top_n: int = 10):
+    """Score a database in reduced dimension first, then rerank the shortlist with full vectors.
+
+    Returns the recall@top_n measured against full-dimension search.
+    """
+    if method not in ("pca", "truncate"):
+        raise ValueError(f"Unknown reduction method: {method}")
+    if reduced_dim < 1 or rerank_factor < 1:
+        raise ValueError("reduced_dim and rerank_factor must both be at least 1.")
+
+    recall = measure_reduced_recall(db_name, reduced_dim, method, rerank_factor, top_n)
+    _reduced_settings[os.path.abspath(db_name)] = (reduced_dim, method, rerank_factor)
+    return recall
+
+def disable_reduced_search(db_name: str):
+    """Go back to scoring a database with full vectors only."""
+    _reduced_settings.pop(os.path.abspath(db_name), None)
+
+def score_pages(db_name: str, query_embedding, top_n: int = 10, focus_only: bool = False, book_ids: list = None, date_from=None, date_to=None, page_range: tuple = None):
+    """Score the pages of one database against an already computed query embedding."""
+    try:
+        index = load_search_index(db_name)
+    except sqlite3.Error:
+        return []
+
+    if index is None or query_embedding is None or len(query_embedding) != index["embeddings"].shape[1]:
+        return []
+
+    query_norm = np.linalg.norm(query_embedding)
+    if query_norm == 0:
+        return []
+
+    # Filter rows before scoring so excluded books cost nothing
+    rows = np.flatnonzero(build_page_mask(index, focus_only, book_ids, date_from, date_to, page_range))
+    if rows.size == 0:
+        return []
+
+    # Sort by similarity (highest first), keep top N above the threshold
+    settings = _reduced_settings.get(os.path.abspath(db_name))
+    rows, similarities = _rank_rows(index, rows, query_embedding / query_norm, top_n, settings)
+    passing = similarities >= 0.6
+    rows, similarities = rows[passing], similarities[passing]
+
+    page_ids = index["page_ids"][rows].tolist()
+    texts = database_commands.get_page_texts(db_name, page_ids)
+
+    return [
+        [page_id, int(index["book_ids"][row]), int(index["page_numbers"][row]), float(similarity), texts.get(page_id)]
+        for page_id, row, similarity in zip(page_ids, rows, similarities)
+    ]
+
+def find_similar_pages(db_name: str, query: str, url_of_api: str, model_name: str, top_n: int = 10, focus_only: bool = False, book_ids: list = None, date_from=None, date_to=None, page_range: tuple = None):
     """Find the top N most similar pages to the query based on cosine similarity, with optional focus filtering."""
-    
+
     query_embedding = get_query_embedding(query, url_of_api, model_name)
     if query_embedding is None:
         return []
 
-    try:
-        if os.path.exists(db_name):
-            conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-    except:
+    return score_pages(db_name, query_embedding, top_n, focus_only, book_ids, date_from, date_to, page_range)
+
+def find_similar_pages_federated(db_names: list, query: str, url_of_api: str, model_name: str, top_n: int = 10, focus_only: bool = False, max_workers: int = None):
+    """Search several databases in parallel with one query embedding and merge their results into a global top N."""
+
+    query_embedding = get_query_embedding(query, url_of_api, model_name)
+    if query_embedding is None or not db_names:
         return []
 
-    # Retrieve pages but exclude pages from excluded books
-    if focus_only:
-        cursor.execute("""
-        SELECT p.id, p.book_id, p.page_number, p.text, p.embedding 
-        FROM pages p 
-        JOIN books b ON p.book_id = b.id 
-        WHERE b.excluded = 0 AND b.focused = 1
-        """)
-    else:
-        cursor.execute("""
-        SELECT p.id, p.book_id, p.page_number, p.text, p.embedding 
-        FROM pages p 
-        JOIN books b ON p.book_id = b.id 
-        WHERE b.excluded = 0
-        """)
-
-    pages = cursor.fetchall()
-    conn.close()
-
-    results = []
-    
-    for page in pages:
-        page_id, book_id, page_number, text, embedding_blob = page
-        if embedding_blob is None:
-            continue  # Skip pages without embeddings
-
-        # Convert BLOB back to numpy array
-        embedding = np.frombuffer(embedding_blob, dtype=np.float32)
-
-        # Compute similarity
-        similarity = cosine_similarity(query_embedding, embedding)
-        if similarity >= 0.6:
-            results.append([page_id, book_id, page_number, similarity, text])
-
-    # Sort by similarity (highest first) and return top N
-    results.sort(key=lambda x: x[3], reverse=True)
-    return results[:top_n]
-
-def search_and_return_results(db_name: str, query: str, url_of_api: str, model_name: str, top_n: int = 10, focus_only: bool = False):
+    # Each shard returns its own top N, the global top N is always among them
+    def search_shard(db_name):
+        try:
+            return [[db_name] + match for match in score_pages(db_name, query_embedding, top_n, focus_only)]
+        except RuntimeError as e:  # Not migrated yet, the other shards still answer
+            logger.warning("Skipping %s in federated search: %s", db_name, e)
+            return []
+
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(db_names), os.cpu_count() or 1)) as executor:
+        shard_results = list(executor.map(search_shard, db_names))
+
+    # Rows are [db_name, page_id, book_id, page_number, similarity, text]
+    return heapq.nlargest(top_n, (match for shard in shard_results for match in shard), key=lambda x: x[4])
+
+def search_and_return_results(db_name: str, query: str, url_of_api: str, model_name: str, top_n: int = 10, focus_only: bool = False, book_ids: list = None, date_from=None, date_to=None, page_range: tuple = None):
     """Search for the most relevant pages and return them in a readable format."""
-    top_matches = find_similar_pages(db_name, query, url_of_api, model_name, top_n, focus_only)
+    top_matches = find_similar_pages(db_name, query, url_of_api, model_name, top_n, focus_only, book_ids, date_from, date_to, page_range)
     top_matches_data = []
     for item in top_matches:
         top_matches_data.append(item[4])
@@ -83,5 +442,11 @@ def search_and_return_results(db_name: str, query: str, url_of_api: str, model_n
 
     return top_matches_data
 
+def federated_search_and_return_results(db_names: list, query: str, url_of_api: str, model_name: str, top_n: int = 10, focus_only: bool = False):
+    """Search several databases and return the page texts of the global top N."""
+    top_matches = find_similar_pages_federated(db_names, query, url_of_api, model_name, top_n, focus_only)
 
+    if not top_matches:
+        return None
 
+    return [item[5] for item in top_matches]
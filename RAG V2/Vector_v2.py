@@ -1,9 +1,13 @@
 import re
 import os
+import hashlib
 import fitz  # PyMuPDF
 from tqdm.auto import tqdm
 import requests
 
+# One session for every call to the model API, keeps connections warm between requests
+session = requests.Session()
+
 def clean_text(text: str) -> str:
     """Cleans text by removing excessive newlines and spaces."""
     text = re.sub(r'\s+', ' ', text)  # Replace multiple spaces/newlines with a single space
@@ -46,8 +50,17 @@ def open_and_read_pdf(pdf_path: str, start_page: int = 0, stop_page: int = None)
 
     return pages_and_texts
 
-def get_text_vectors(list_of_items: list, url_of_api: str, model_name: str):
-    for item in list_of_items:
+def file_content_hash(file_path: str) -> str:
+    """SHA-256 of a file's bytes, read in blocks so large PDFs aren't loaded whole."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_text_vectors(list_of_items: list, url_of_api: str, model_name: str, progress_callback=None):
+    """Adds an embedding to every item, calling progress_callback(done, total) after each one."""
+    for done, item in enumerate(list_of_items, start=1):
         text_for_vectoring = item["text"]
 
         data = {
@@ -55,7 +68,7 @@ def get_text_vectors(list_of_items: list, url_of_api: str, model_name: str):
             "prompt": text_for_vectoring
         }
 
-        response = requests.post(url_of_api, json=data)
+        response = session.post(url_of_api, json=data)
 
         if response.status_code == 200:
             json_response = response.json()
@@ -63,4 +76,7 @@ def get_text_vectors(list_of_items: list, url_of_api: str, model_name: str):
         else:
             item["embedding"] = None  
 
+        if progress_callback:
+            progress_callback(done, len(list_of_items))
+
     return list_of_items
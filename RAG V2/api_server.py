@@ -0,0 +1,326 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import interphase
+
+api_url = "<your URL>"
+model = "<your Model>"
+db_name = "<your DB Name>"
+db_directory = "."  # Requests may only pick a "db" among the .db files in this folder
+
+embed_url = "<your URL2>"
+embed_model = "<your embed Model>"
+
+host = "127.0.0.1"
+port = 8080
+
+MAX_CONCURRENT_REQUESTS = 8  # Searches/queries served at once, the rest wait their turn
+INGEST_WORKERS = 1  # Books embedded at the same time
+MAX_PROMPT_TOKENS = 131072  # Prompt ceiling for /query, set it to the chat model's context window
+
+_started_at = time.time()
+_request_slots = None  # asyncio.Semaphore, created with the app's event loop
+_ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+_job_ids = itertools.count(1)
+_jobs = {}
+_jobs_lock = threading.Lock()
+_metrics = {"requests": {}, "errors": 0, "in_flight": 0}
+
+
+async def run_limited(func, *args):
+    """Run a blocking call on a worker thread, at most MAX_CONCURRENT_REQUESTS at a time."""
+    async with _request_slots:
+        return await asyncio.to_thread(func, *args)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Count requests and time them per endpoint."""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else "<unmatched>"
+    stats = _metrics["requests"].setdefault(route, {"count": 0, "total_seconds": 0.0})
+    _metrics["in_flight"] += 1
+    started = time.perf_counter()
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        _metrics["errors"] += 1
+        return web.json_response({"error": str(e)}, status=500)
+    finally:
+        _metrics["in_flight"] -= 1
+        stats["count"] += 1
+        stats["total_seconds"] += time.perf_counter() - started
+
+
+async def read_json(request):
+    """Read a JSON body, answering 400 when it is missing or malformed."""
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Request body must be JSON.")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Request body must be a JSON object.")
+    return body
+
+
+def _resolve_db(value):
+    """Default database, or one of the .db files interphase.list_dbs finds in db_directory on the current schema."""
+    if value is None:
+        return db_name
+    if not isinstance(value, str) or value not in interphase.list_dbs(db_directory):
+        raise web.HTTPBadRequest(text="'db' must name one of the .db files in the server's database folder.")
+
+    path = os.path.join(db_directory, value)
+    try:
+        interphase.database_commands.require_current_schema(path)
+    except RuntimeError:
+        raise web.HTTPConflict(text=f"'{value}' uses an older schema, migrate it with database_commands.py before querying it.")
+    return path
+
+
+def _int_field(body: dict, key: str, default, minimum: int = 0):
+    """Read an optional integer field, None stays None when it is the default."""
+    value = body.get(key, default)
+    if value is None and default is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise web.HTTPBadRequest(text=f"'{key}' must be an integer of at least {minimum}.")
+    return value
+
+
+def _bool_field(body: dict, key: str, default: bool = False):
+    """Read an optional boolean field."""
+    value = body.get(key, default)
+    if not isinstance(value, bool):
+        raise web.HTTPBadRequest(text=f"'{key}' must be true or false.")
+    return value
+
+
+def _str_field(body: dict, key: str, default=None):
+    """Read a string field, required when there is no default."""
+    value = body.get(key, default)
+    if not isinstance(value, str) or not value:
+        raise web.HTTPBadRequest(text=f"'{key}' must be a non-empty string.")
+    return value
+
+
+def _search_filters(body: dict):
+    """Validate book_ids, date_from, date_to and page_range for find_similar_pages."""
+    book_ids = body.get("book_ids")
+    if book_ids is not None and (not isinstance(book_ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in book_ids)):
+        raise web.HTTPBadRequest(text="'book_ids' must be a list of integers.")
+
+    dates = []
+    for key in ("date_from", "date_to"):
+        value = body.get(key)
+        if value is not None:
+            try:
+                interphase.SearchDataEmbed._to_datetime64(_str_field(body, key))
+            except ValueError:
+                raise web.HTTPBadRequest(text=f"'{key}' must look like YYYY-MM-DD or YYYY-MM-DD HH:MM:SS.")
+        dates.append(value)
+
+    page_range = body.get("page_range")
+    if page_range is not None:
+        if (not isinstance(page_range, list) or len(page_range) != 2
+                or not all(p is None or (isinstance(p, int) and not isinstance(p, bool)) for p in page_range)):
+            raise web.HTTPBadRequest(text="'page_range' must be [first_page, last_page], either side may be null.")
+        page_range = tuple(page_range)
+
+    return book_ids, dates[0], dates[1], page_range
+
+
+def _memory_field(body: dict):
+    """Validate the conversation memory sent back by the caller."""
+    memory = body.get("memory", [])
+    if not isinstance(memory, list):
+        raise web.HTTPBadRequest(text="'memory' must be a list.")
+    for entry in memory:
+        is_turn = isinstance(entry, dict) and isinstance(entry.get("query"), str) and isinstance(entry.get("response"), str)
+        is_summary = isinstance(entry, dict) and isinstance(entry.get("summary"), str)
+        if not (is_turn or is_summary):
+            raise web.HTTPBadRequest(text="'memory' entries must have string 'query' and 'response', or a string 'summary'.")
+    return list(memory)
+
+
+async def health(request):
+    """Liveness check."""
+    return web.json_response({"status": "ok", "uptime_seconds": round(time.time() - _started_at, 1)})
+
+
+async def metrics(request):
+    """Request counts and latencies, job states and cached indexes."""
+    with _jobs_lock:
+        job_states = [job["status"] for job in _jobs.values()]
+
+    return web.json_response({
+        "uptime_seconds": round(time.time() - _started_at, 1),
+        "in_flight": _metrics["in_flight"],
+        "errors": _metrics["errors"],
+        "requests": {
+            route: {"count": stats["count"], "avg_seconds": stats["total_seconds"] / stats["count"] if stats["count"] else 0.0}
+            for route, stats in _metrics["requests"].items()
+        },
+        "jobs": {status: job_states.count(status) for status in set(job_states)},
+        "cached_indexes": len(interphase.SearchDataEmbed._search_indexes),
+    })
+
+
+async def list_books(request):
+    """List the books of a database (?db= overrides the default)."""
+    books = await run_limited(interphase.database_commands.list_books, _resolve_db(request.query.get("db")))
+    return web.json_response([
+        {"id": book_id, "name": name, "date_added": date_added, "file_name": file_name}
+        for book_id, name, date_added, file_name in books
+    ])
+
+
+async def search(request):
+    """Return the top matching pages for a query, with the same filters as find_similar_pages."""
+    body = await read_json(request)
+    query_text = _str_field(body, "query")
+    db = _resolve_db(body.get("db"))
+    top_n = _int_field(body, "top_n", 10, minimum=1)
+    focus_only = _bool_field(body, "focus_only")
+    book_ids, date_from, date_to, page_range = _search_filters(body)
+
+    matches = await run_limited(
+        interphase.SearchDataEmbed.find_similar_pages,
+        db, query_text, embed_url, embed_model, top_n, focus_only,
+        book_ids, date_from, date_to, page_range,
+    )
+
+    return web.json_response([
+        {"page_id": page_id, "book_id": book_id, "page_number": page_number, "similarity": similarity, "text": text}
+        for page_id, book_id, page_number, similarity, text in matches
+    ])
+
+
+async def query(request):
+    """Answer a query with retrieved context, the caller passes its memory in and gets it back compacted."""
+    body = await read_json(request)
+    query_text = _str_field(body, "query")
+    db = _resolve_db(body.get("db"))
+    top_n = _int_field(body, "top_n", 3, minimum=1)
+    focus_only = _bool_field(body, "focus_only")
+    chat_model = _str_field(body, "model", model)
+    memory = _memory_field(body)
+
+    rag_items = await run_limited(
+        interphase.SearchDataEmbed.search_and_return_results,
+        db, query_text, embed_url, embed_model, top_n, focus_only,
+    )
+
+    # Memory is kept by the caller, the server stays stateless between queries
+    response, memory = await run_limited(
+        interphase.query_ai_system,
+        api_url, query_text, chat_model, rag_items, memory, MAX_PROMPT_TOKENS,
+    )
+
+    # Compacted before it goes back, so the memory the caller resends stays bounded too
+    memory = await run_limited(interphase.compact_memory, api_url, chat_model, memory)
+
+    return web.json_response({"response": response, "memory": memory})
+
+
+def _run_ingest_job(job_id: int, db: str, pdf_path: str, start_page: int, stop_page: int):
+    """Ingest one book on the ingest pool, recording progress on the job."""
+    job = _jobs[job_id]
+
+    def progress(stage, done, total):
+        with _jobs_lock:
+            job.update(stage=stage, done=done, total=total)
+
+    with _jobs_lock:
+        job["status"] = "running"
+    try:
+        result = interphase.add_complete_book(db, pdf_path, embed_url, embed_model, start_page, stop_page, progress)
+        with _jobs_lock:
+            job.update(status="done", result=result)
+    except Exception as e:
+        with _jobs_lock:
+            job.update(status="failed", result=str(e))
+    finally:
+        with _jobs_lock:
+            job["finished_at"] = time.time()
+
+
+async def ingest(request):
+    """Queue a PDF for ingestion and return its job id straight away."""
+    body = await read_json(request)
+    pdf_path = _str_field(body, "pdf_path")
+    if not os.path.isfile(pdf_path):
+        raise web.HTTPBadRequest(text="'pdf_path' must be an existing file on the server.")
+    db = _resolve_db(body.get("db"))
+    start_page = _int_field(body, "start_page", 0)
+    stop_page = _int_field(body, "stop_page", None)
+
+    job_id = next(_job_ids)
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "id": job_id, "pdf_path": pdf_path, "status": "queued",
+            "stage": None, "done": 0, "total": 0, "result": None,
+            "created_at": time.time(), "finished_at": None,
+        }
+
+    _ingest_executor.submit(_run_ingest_job, job_id, db, pdf_path, start_page, stop_page)
+    return web.json_response({"job_id": job_id}, status=202)
+
+
+async def list_jobs(request):
+    """List every ingest job with its progress."""
+    with _jobs_lock:
+        return web.json_response(list(_jobs.values()))
+
+
+async def get_job(request):
+    """Poll one ingest job."""
+    with _jobs_lock:
+        job = _jobs.get(int(request.match_info["job_id"]))
+        if job is None:
+            raise web.HTTPNotFound(text="No such job.")
+        return web.json_response(dict(job))
+
+
+async def on_startup(app):
+    """Create the request limiter and warm the search index."""
+    global _request_slots
+    _request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    # Migrate once here so searches never have to, then load the embedding index before the first request needs it
+    await asyncio.to_thread(interphase.database_commands.create_database, db_name)
+    await asyncio.to_thread(interphase.SearchDataEmbed.load_search_index, db_name)
+
+
+async def on_cleanup(app):
+    """Stop ingest workers and close the shared HTTP session."""
+    _ingest_executor.shutdown(wait=False, cancel_futures=True)
+    interphase.Vector_v2.session.close()
+
+
+def create_app():
+    """Build the aiohttp application."""
+    app = web.Application(middlewares=[metrics_middleware])
+    app.add_routes([
+        web.get("/health", health),
+        web.get("/metrics", metrics),
+        web.get("/books", list_books),
+        web.post("/search", search),
+        web.post("/query", query),
+        web.post("/ingest", ingest),
+        web.get("/jobs", list_jobs),
+        web.get(r"/jobs/{job_id:\d+}", get_job),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=host, port=port)
@@ -0,0 +1,237 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import interphase
+
+# watchdog uses inotify on Linux, without it the folder is polled
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+watch_directory = "<your Drop Folder>"
+db_name = "<your DB Name>"
+
+embed_url = "<your URL2>"
+embed_model = "<your embed Model>"
+
+WORKERS = 1  # Files ingested at the same time
+DEBOUNCE_SECONDS = 5.0  # A file must be unchanged this long before it is queued
+POLL_INTERVAL = 2.0  # Seconds between folder scans (polling mode) and idle queue checks
+
+database_commands = interphase.database_commands
+logger = logging.getLogger("auto_add")
+
+
+def _file_state(path: str):
+    """Size and modification time of a file, None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class _DropFolderEvents(FileSystemEventHandler):
+    """Forwards watchdog events for PDFs to the watcher."""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.note_change(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.note_change(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.note_change(event.dest_path)
+
+
+class DropFolderWatcher:
+    """Watches a folder for new or changed PDFs and ingests them from a queue stored in the database."""
+
+    def __init__(self, directory: str, db_name: str, url_of_api: str, model_name: str, workers: int = WORKERS,
+                 debounce_seconds: float = DEBOUNCE_SECONDS, poll_interval: float = POLL_INTERVAL, use_polling: bool = False):
+        self.directory = directory
+        self.db_name = db_name
+        self.url_of_api = url_of_api
+        self.model_name = model_name
+        self.workers = workers
+        self.debounce_seconds = debounce_seconds
+        self.poll_interval = poll_interval
+        self.use_polling = use_polling or Observer is None
+
+        self._pending = {}  # path -> {"stat": (size, mtime), "seen": time of last change}
+        self._pending_lock = threading.Lock()
+        self._jobs_waiting = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._observer = None
+
+    def note_change(self, path: str):
+        """Record that a PDF was created or modified, it is queued once it stops changing."""
+        if not path.lower().endswith(".pdf"):
+            return
+        with self._pending_lock:
+            self._pending[path] = {"stat": _file_state(path), "seen": time.monotonic()}
+
+    def _scan(self, known: dict):
+        """Polling fallback: compare the folder against the last scan and note changed PDFs."""
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.lower().endswith(".pdf"):
+                current[entry.path] = _file_state(entry.path)
+                if known.get(entry.path) != current[entry.path]:
+                    self.note_change(entry.path)
+        return current
+
+    def _poll_loop(self):
+        known = {}
+        while not self._stop.is_set():
+            try:
+                known = self._scan(known)
+            except OSError:
+                logger.exception("Could not scan %s, retrying", self.directory)
+            self._stop.wait(self.poll_interval)
+
+    def _debounce_loop(self):
+        """Queue files that have not changed for debounce_seconds."""
+        while not self._stop.wait(min(1.0, self.debounce_seconds)):
+            try:
+                self._queue_settled_files()
+            except Exception:
+                logger.exception("Debounce pass failed, retrying")
+
+    def _queue_settled_files(self):
+        """One debounce pass: queue every pending file that has settled."""
+        now = time.monotonic()
+        ready = []
+        with self._pending_lock:
+            for path, entry in list(self._pending.items()):
+                state = _file_state(path)
+                if state is None:
+                    del self._pending[path]  # Deleted or moved away before it settled
+                elif state != entry["stat"]:
+                    entry.update(stat=state, seen=now)  # Still being written
+                elif now - entry["seen"] >= self.debounce_seconds:
+                    del self._pending[path]
+                    ready.append(path)
+
+        for path in ready:
+            self._enqueue(path)
+
+    def _enqueue(self, path: str):
+        """Hash a settled file and add it to the job queue unless its content is already stored."""
+        try:
+            content_hash = interphase.Vector_v2.file_content_hash(path)
+        except OSError:
+            self.note_change(path)  # Not readable yet, try again after another debounce
+            return
+
+        try:
+            if database_commands.get_book_by_hash(self.db_name, content_hash):
+                return
+            database_commands.enqueue_ingest_job(self.db_name, path, content_hash)
+        except sqlite3.Error:
+            logger.exception("Could not queue %s, retrying", path)
+            self.note_change(path)  # e.g. database is locked, try again after another debounce
+            return
+
+        self._jobs_waiting.set()
+
+    def _ingest(self, job_id: int, path: str, content_hash: str):
+        """Ingest one queued file, replacing an older version of the same file."""
+        if not os.path.exists(path):
+            database_commands.finish_ingest_job(self.db_name, job_id, "failed", "File no longer exists.")
+            return
+
+        if database_commands.get_book_by_hash(self.db_name, content_hash):
+            database_commands.finish_ingest_job(self.db_name, job_id, "skipped", "Content already stored.")
+            return
+
+        # Same file name with new content means the file was modified, the old book is
+        # swapped out only after the new version is stored, so a failed embed loses nothing
+        result = interphase.add_complete_book(self.db_name, path, self.url_of_api, self.model_name, replace_existing=True)
+        database_commands.finish_ingest_job(self.db_name, job_id, "done", result)
+        logger.info(result)
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                job = database_commands.claim_ingest_job(self.db_name)
+            except sqlite3.Error:
+                logger.exception("Could not claim a job, retrying")
+                self._stop.wait(self.poll_interval)
+                continue
+
+            if job is None:
+                self._jobs_waiting.wait(self.poll_interval)
+                self._jobs_waiting.clear()
+                continue
+
+            job_id, path, content_hash = job
+            try:
+                self._ingest(job_id, path, content_hash)
+            except Exception as e:
+                logger.exception("Ingesting %s failed", path)
+                try:
+                    database_commands.finish_ingest_job(self.db_name, job_id, "failed", str(e))
+                except sqlite3.Error:
+                    logger.exception("Could not mark job %s failed, it is requeued on the next start", job_id)
+
+    def start(self):
+        """Start watching and ingesting on background threads."""
+        database_commands.create_database(self.db_name)
+        database_commands.requeue_running_jobs(self.db_name)  # Left running by a previous run
+
+        # Files dropped while nothing was watching
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                self.note_change(entry.path)
+
+        if self.use_polling:
+            targets = [self._poll_loop]
+        else:
+            self._observer = Observer()
+            self._observer.schedule(_DropFolderEvents(self), self.directory, recursive=False)
+            self._observer.start()
+            targets = []
+
+        targets.append(self._debounce_loop)
+        targets.extend([self._worker_loop] * self.workers)
+
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop watching, a file being ingested is finished first."""
+        self._stop.set()
+        self._jobs_waiting.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    watcher = DropFolderWatcher(watch_directory, db_name, embed_url, embed_model)
+    watcher.start()
+    print(f"Watching {watch_directory} ({'polling' if watcher.use_polling else 'inotify'}) with {WORKERS} worker(s).")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        watcher.stop()
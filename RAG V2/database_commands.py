@@ -1,25 +1,35 @@
 import sqlite3
+import os
+import re
+import sys
+import time
+import zlib
+import threading
 from datetime import datetime
 import numpy as np
 
-def create_database(db_name: str):
-    """Create a new SQLite database with Book and Page tables."""
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+# Bumped whenever the table layout changes, stored in PRAGMA user_version
+SCHEMA_VERSION = 3
 
-    # Create the Book table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS books (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        date_added TEXT NOT NULL,
-        file_name TEXT NOT NULL,
-        excluded INTEGER DEFAULT 0,  -- Used for excluding books (0 = active, 1 = excluded)
-        focused INTEGER DEFAULT 0    -- Used for focusing on specific books (0 = normal, 1 = focused)
-    )
-    ''')
+# Page text is stored zlib-compressed when enabled (text_compression = 'zlib')
+COMPRESS_PAGE_TEXT = False
+
+INCREMENTAL_VACUUM_STEP = 500  # Free pages released per background vacuum step
+_vacuums_running = set()
+_current_schema_dbs = set()  # Files already checked by require_current_schema
+_vacuum_lock = threading.Lock()
+
+# Callables run after a write as listener(db_name, book_id, flags), flags is None when rows were removed.
+# New pages need no notice, the search index picks them up from the file's data_version.
+change_listeners = []
 
-    # Create the Page table
+def _notify_change(db_name: str, book_id: int = None, flags: dict = None):
+    """Tell listeners (such as the cached search index) that the database changed."""
+    for listener in change_listeners:
+        listener(db_name, book_id, flags)
+
+def _create_page_tables(cursor):
+    """Create the page tables: cold page text in pages, hot embeddings in their own narrow table."""
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS pages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -30,30 +40,232 @@ def create_database(db_name: str):
         page_word_count FLOAT,
         page_token_count FLOAT,
         text TEXT,
-        embedding BLOB,
+        text_compression TEXT,  -- NULL = plain text, 'zlib' = zlib-compressed UTF-8
         FOREIGN KEY(book_id) REFERENCES books(id) ON DELETE CASCADE
     )
     ''')
 
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS page_embeddings (
+        page_id INTEGER PRIMARY KEY,
+        embedding BLOB NOT NULL,
+        FOREIGN KEY(page_id) REFERENCES pages(id) ON DELETE CASCADE
+    )
+    ''')
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pages_file_page ON pages (file_name, page_number)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pages_book_id ON pages (book_id, page_number)")
+
+
+def _create_ingest_tables(cursor):
+    """Create the persistent queue used by the auto-add watcher."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_path TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending, running, done, skipped, failed
+        message TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    ''')
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_content_hash ON books (content_hash)")
+
+
+def _read_schema_version(cursor):
+    """Schema version seen through an open cursor, 1 for databases from before versioning."""
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0:
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'pages'")
+        version = 1 if cursor.fetchone()[0] else SCHEMA_VERSION
+    return version
+
+
+def get_schema_version(db_name: str):
+    """Return the schema version of a database, 1 for databases from before versioning."""
+    conn = sqlite3.connect(db_name)
+    version = _read_schema_version(conn.cursor())
+    conn.close()
+    return version
+
+
+def require_current_schema(db_name: str):
+    """Raise if a database still needs migrate_database, instead of failing on a missing table or column."""
+    key = os.path.abspath(db_name)
+    if key in _current_schema_dbs or not os.path.exists(db_name):
+        return
+
+    version = get_schema_version(db_name)
+    if version < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"{db_name} uses schema version {version}, run migrate_database (or create_database) on it first."
+        )
+    _current_schema_dbs.add(key)
+
+
+def create_database(db_name: str):
+    """Create a new SQLite database with Book and Page tables, upgrading an older one in place."""
+    if os.path.exists(db_name) and get_schema_version(db_name) < SCHEMA_VERSION:
+        migrate_database(db_name)
+        return
+
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    # Must be set before the first table is created to take effect without a VACUUM
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # Create the Book table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS books (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        date_added TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        excluded INTEGER DEFAULT 0,  -- Used for excluding books (0 = active, 1 = excluded)
+        focused INTEGER DEFAULT 0,   -- Used for focusing on specific books (0 = normal, 1 = focused)
+        content_hash TEXT            -- SHA-256 of the source file, used to skip files already added
+    )
+    ''')
+
+    # Create the Page tables
+    _create_page_tables(cursor)
+    _create_ingest_tables(cursor)
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
     conn.commit()
+
+    # WAL lets searches keep reading while background ingestion writes
+    cursor.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+
+def migrate_database(db_name: str, compress: bool = None):
+    """Upgrade an older database to the current schema, one version at a time.
+
+    Each step re-reads the version under a write lock, so concurrent callers (or processes) migrate only once.
+    Run it at startup, the version 2 step ends with a full VACUUM.
+    """
+    if get_schema_version(db_name) >= SCHEMA_VERSION:
+        return
+    if compress is None:
+        compress = COMPRESS_PAGE_TEXT
+
+    # A long timeout so a second caller waits for a running migration instead of failing
+    conn = sqlite3.connect(db_name, timeout=600, isolation_level=None)
+    cursor = conn.cursor()
+
+    # Version 2: embeddings move out of pages into page_embeddings
+    cursor.execute("BEGIN IMMEDIATE")
+    if _read_schema_version(cursor) < 2:
+        cursor.execute("ALTER TABLE pages RENAME TO pages_v1")
+        _create_page_tables(cursor)
+
+        cursor.execute("SELECT id, book_id, file_name, page_number, page_char_count, page_word_count, page_token_count, text FROM pages_v1")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            conn.executemany('''
+            INSERT INTO pages (id, book_id, file_name, page_number, page_char_count, page_word_count, page_token_count, text, text_compression)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [row[:7] + _pack_text(row[7], compress) for row in rows])
+
+        cursor.execute("INSERT INTO page_embeddings (page_id, embedding) SELECT id, embedding FROM pages_v1 WHERE embedding IS NOT NULL")
+        cursor.execute("DROP TABLE pages_v1")
+        cursor.execute("PRAGMA user_version = 2")
+        cursor.execute("COMMIT")
+
+        # Switching auto_vacuum on an existing file only takes effect after a full VACUUM
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    else:
+        cursor.execute("COMMIT")
+
+    # Version 3: content hashes on books and the ingest job queue
+    cursor.execute("BEGIN IMMEDIATE")
+    if _read_schema_version(cursor) < 3:
+        cursor.execute("ALTER TABLE books ADD COLUMN content_hash TEXT")
+        _create_ingest_tables(cursor)
+        cursor.execute("PRAGMA user_version = 3")
+    cursor.execute("COMMIT")
+    cursor.execute("PRAGMA journal_mode = WAL")
+
     conn.close()
+    _notify_change(db_name)
+
+
+def _pack_text(text: str, compress: bool):
+    """Return (stored_text, text_compression) for a page text."""
+    if compress and text:
+        return zlib.compress(text.encode("utf-8")), "zlib"
+    return text, None
+
 
-def add_book(db_name: str, book_name: str, file_name: str):
-    """Add a book to the database, avoiding duplicates."""
+def _unpack_text(stored_text, text_compression: str):
+    """Turn stored page text back into a string."""
+    if text_compression == "zlib":
+        return zlib.decompress(stored_text).decode("utf-8")
+    return stored_text
+
+
+def incremental_vacuum(db_name: str, step: int = INCREMENTAL_VACUUM_STEP):
+    """Release free pages back to the filesystem in small steps so readers are never blocked for long."""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    try:
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return  # Not an incremental database, run migrate_database first
+
+        while cursor.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            # executescript steps the pragma to completion, execute() frees a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(step)});")
+            time.sleep(0.05)  # Give other connections a chance at the lock
+    finally:
+        conn.close()
+
+
+def incremental_vacuum_in_background(db_name: str, step: int = INCREMENTAL_VACUUM_STEP):
+    """Run incremental_vacuum on a daemon thread, at most one per database."""
+    key = os.path.abspath(db_name)
+    with _vacuum_lock:
+        if key in _vacuums_running:
+            return
+        _vacuums_running.add(key)
+
+    def run():
+        try:
+            incremental_vacuum(db_name, step)
+        finally:
+            with _vacuum_lock:
+                _vacuums_running.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def add_book(db_name: str, book_name: str, file_name: str, content_hash: str = None, allow_duplicate: bool = False):
+    """Add a book to the database, avoiding duplicates, and return its id (None if it already existed).
+
+    allow_duplicate adds a second row with the same name, used while a new version replaces the old one.
+    """
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
     # Check if the book already exists
     cursor.execute("SELECT COUNT(*) FROM books WHERE name = ? AND file_name = ?", (book_name, file_name))
-    if cursor.fetchone()[0] > 0:
+    if cursor.fetchone()[0] > 0 and not allow_duplicate:
         conn.close()
-        return
+        return None
 
     date_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    cursor.execute("INSERT INTO books (name, date_added, file_name) VALUES (?, ?, ?)", (book_name, date_added, file_name))
+    cursor.execute("INSERT INTO books (name, date_added, file_name, content_hash) VALUES (?, ?, ?, ?)", (book_name, date_added, file_name, content_hash))
+    book_id = cursor.lastrowid
     conn.commit()
     conn.close()
+    return book_id
 
 
 def get_book(db_name: str, search_value):
@@ -73,9 +285,27 @@ def get_book(db_name: str, search_value):
 
 
 
-def add_page(db_name: str, page_data: dict):
-    """Add a page to a book in the database, ensuring no duplicates."""
-    search_value = page_data.get('file_name')
+def get_book_by_hash(db_name: str, content_hash: str):
+    """Get the book whose source file had this content hash."""
+    require_current_schema(db_name)
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM books WHERE content_hash = ?", (content_hash,))
+    book = cursor.fetchone()
+    conn.close()
+    return book  # Returns None if no book found
+
+
+def add_page(db_name: str, page_data: dict, compress: bool = None):
+    """Add a page to a book in the database, ensuring no duplicates.
+
+    compress defaults to COMPRESS_PAGE_TEXT, read at call time. A 'book_id' in page_data
+    picks the book directly, otherwise it is looked up by 'file_name'.
+    """
+    require_current_schema(db_name)
+    if compress is None:
+        compress = COMPRESS_PAGE_TEXT
+    search_value = page_data.get('book_id') or page_data.get('file_name')
     book = get_book(db_name, search_value)
 
     if not book:
@@ -87,8 +317,11 @@ def add_page(db_name: str, page_data: dict):
     page_char_count = page_data.get('page_char_count')
     page_word_count = page_data.get('page_word_count')
     page_token_count = page_data.get('page_token_count')
-    text = page_data.get('text')
-    embedding = np.array(page_data.get('embedding'), dtype=np.float32).tobytes()
+    embedding = page_data.get('embedding')
+    if embedding is None or len(embedding) == 0:
+        raise ValueError(f"Page {page_number} of {file_name} has no embedding.")
+    text, text_compression = _pack_text(page_data.get('text'), compress)
+    embedding = np.array(embedding, dtype=np.float32).tobytes()
 
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
@@ -99,9 +332,10 @@ def add_page(db_name: str, page_data: dict):
         return
 
     cursor.execute('''
-    INSERT INTO pages (book_id, file_name, page_number, page_char_count, page_word_count, page_token_count, text, embedding)
+    INSERT INTO pages (book_id, file_name, page_number, page_char_count, page_word_count, page_token_count, text, text_compression)
     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (book_id, file_name, page_number, page_char_count, page_word_count, page_token_count, text, embedding))
+    ''', (book_id, file_name, page_number, page_char_count, page_word_count, page_token_count, text, text_compression))
+    cursor.execute("INSERT INTO page_embeddings (page_id, embedding) VALUES (?, ?)", (cursor.lastrowid, embedding))
 
     conn.commit()
     conn.close()
@@ -109,6 +343,7 @@ def add_page(db_name: str, page_data: dict):
 
 def remove_book(db_name: str, search_value: str):
     """Remove a book and all associated pages from the database."""
+    require_current_schema(db_name)
     book = get_book(db_name, search_value)
     if not book:
         return
@@ -118,31 +353,30 @@ def remove_book(db_name: str, search_value: str):
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
+    cursor.execute("DELETE FROM page_embeddings WHERE page_id IN (SELECT id FROM pages WHERE book_id = ?)", (book_id,))
     cursor.execute("DELETE FROM pages WHERE book_id = ?", (book_id,))
     cursor.execute("DELETE FROM books WHERE id = ?", (book_id,))
 
     conn.commit()
-
-    # Check the free space before vacuuming
-    cursor.execute("PRAGMA freelist_count;")
-    free_pages = cursor.fetchone()[0]
-
-    # Only VACUUM if a lot of space is freed
-    if free_pages > 1000:  # Adjust threshold based on usage
-        cursor.execute("VACUUM")
-
     conn.close()
+    _notify_change(db_name, book_id)
+
+    # Hand the freed space back in small steps instead of a blocking VACUUM
+    incremental_vacuum_in_background(db_name)
 
 
 
 def remove_page(db_name: str, file_name: str, page_number: int):
     """Remove a specific page from the database."""
+    require_current_schema(db_name)
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
+    cursor.execute("DELETE FROM page_embeddings WHERE page_id IN (SELECT id FROM pages WHERE file_name = ? AND page_number = ?)", (file_name, page_number))
     cursor.execute("DELETE FROM pages WHERE file_name = ? AND page_number = ?", (file_name, page_number))
     conn.commit()
     conn.close()
+    _notify_change(db_name)
 
 
 def list_books(db_name: str):
@@ -159,6 +393,7 @@ def list_books(db_name: str):
 
 def list_pages(db_name: str, search_value: str):
     """List all pages for a specific book."""
+    require_current_schema(db_name)
     book = get_book(db_name, search_value)
     if not book:
         return []
@@ -168,19 +403,41 @@ def list_pages(db_name: str, search_value: str):
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT page_number, text FROM pages WHERE book_id = ?", (book_id,))
-    pages = cursor.fetchall()
+    cursor.execute("SELECT page_number, text, text_compression FROM pages WHERE book_id = ?", (book_id,))
+    pages = [(page_number, _unpack_text(text, text_compression)) for page_number, text, text_compression in cursor.fetchall()]
     conn.close()
 
     return pages
 
 
+def get_page_texts(db_name: str, page_ids: list):
+    """Retrieve the text of several pages by id, returned as a dict of id to text."""
+    require_current_schema(db_name)
+    if not page_ids:
+        return {}
+
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    placeholders = ",".join("?" * len(page_ids))
+    cursor.execute(f"SELECT id, text, text_compression FROM pages WHERE id IN ({placeholders})", list(page_ids))
+    texts = {page_id: _unpack_text(text, text_compression) for page_id, text, text_compression in cursor.fetchall()}
+    conn.close()
+
+    return texts
+
+
 def get_vectors(db_name: str, file_name: str, page_number: int):
     """Retrieve the vector embedding for a specific page."""
+    require_current_schema(db_name)
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT embedding FROM pages WHERE file_name = ? AND page_number = ?", (file_name, page_number))
+    cursor.execute('''
+    SELECT e.embedding FROM page_embeddings e
+    JOIN pages p ON p.id = e.page_id
+    WHERE p.file_name = ? AND p.page_number = ?
+    ''', (file_name, page_number))
     result = cursor.fetchone()
     conn.close()
 
@@ -202,6 +459,7 @@ def exclude_book(db_name: str, search_value: str):
     cursor.execute("UPDATE books SET excluded = 1 WHERE id = ?", (book_id,))
     conn.commit()
     conn.close()
+    _notify_change(db_name, book_id, {"excluded": True})
 
 def include_book(db_name: str, search_value: str):
     """Mark a book as excluded without deleting it."""
@@ -216,6 +474,7 @@ def include_book(db_name: str, search_value: str):
     cursor.execute("UPDATE books SET excluded = 0 WHERE id = ?", (book_id,))
     conn.commit()
     conn.close()
+    _notify_change(db_name, book_id, {"excluded": False})
 
 
 def focus_book(db_name: str, search_value: str):
@@ -231,6 +490,7 @@ def focus_book(db_name: str, search_value: str):
     cursor.execute("UPDATE books SET focused = 1 WHERE id = ?", (book_id,))
     conn.commit()
     conn.close()
+    _notify_change(db_name, book_id, {"focused": True})
 
 
 def un_focus_book(db_name: str, search_value: str):
@@ -246,3 +506,199 @@ def un_focus_book(db_name: str, search_value: str):
     cursor.execute("UPDATE books SET focused = 0 WHERE id = ?", (book_id,))
     conn.commit()
     conn.close()
+    _notify_change(db_name, book_id, {"focused": False})
+
+
+def enqueue_ingest_job(db_name: str, file_path: str, content_hash: str):
+    """Queue a file for ingestion unless the same content is already queued or running."""
+    require_current_schema(db_name)
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT id FROM ingest_jobs WHERE file_path = ? AND content_hash = ? AND status IN ('pending', 'running')",
+        (file_path, content_hash)
+    )
+    existing = cursor.fetchone()
+    if existing:
+        conn.close()
+        return existing[0]
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(
+        "INSERT INTO ingest_jobs (file_path, content_hash, created_at, updated_at) VALUES (?, ?, ?, ?)",
+        (file_path, content_hash, now, now)
+    )
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def claim_ingest_job(db_name: str):
+    """Mark the oldest pending job as running and return (id, file_path, content_hash), or None."""
+    require_current_schema(db_name)
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    cursor = conn.cursor()
+
+    # IMMEDIATE takes the write lock up front so two workers can't claim the same job
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT id, file_path, content_hash FROM ingest_jobs WHERE status = 'pending' ORDER BY id LIMIT 1")
+    job = cursor.fetchone()
+    if job:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute("UPDATE ingest_jobs SET status = 'running', updated_at = ? WHERE id = ?", (now, job[0]))
+    cursor.execute("COMMIT")
+    conn.close()
+    return job
+
+
+def finish_ingest_job(db_name: str, job_id: int, status: str, message: str = None):
+    """Record the outcome of a job (done, skipped or failed)."""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute("UPDATE ingest_jobs SET status = ?, message = ?, updated_at = ? WHERE id = ?", (status, message, now, job_id))
+    conn.commit()
+    conn.close()
+
+
+def requeue_running_jobs(db_name: str):
+    """Put jobs left running by a previous process back in the queue."""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE ingest_jobs SET status = 'pending' WHERE status = 'running'")
+    requeued = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return requeued
+
+
+def list_ingest_jobs(db_name: str, status: str = None):
+    """List queued jobs, optionally only those with one status."""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    if status is None:
+        cursor.execute("SELECT id, file_path, status, message, created_at, updated_at FROM ingest_jobs ORDER BY id")
+    else:
+        cursor.execute("SELECT id, file_path, status, message, created_at, updated_at FROM ingest_jobs WHERE status = ? ORDER BY id", (status,))
+    jobs = cursor.fetchall()
+    conn.close()
+    return jobs
+
+
+def _shard_directory(db_name: str, output_directory: str = None):
+    """Where the shards of a database go, "<db name>_shards" next to it by default, never beside it."""
+    if output_directory is None:
+        output_directory = os.path.splitext(db_name)[0] + "_shards"
+    if os.path.abspath(output_directory) == os.path.abspath(os.path.dirname(db_name) or "."):
+        raise ValueError("Shards must go to a different folder than the source database.")
+    return output_directory
+
+
+def _existing_shards(db_name: str, output_directory: str):
+    """Map book id -> shard files of this source database already in output_directory."""
+    base_name = os.path.splitext(os.path.basename(db_name))[0]
+    pattern = re.compile(re.escape(base_name) + r"_(\d+)_.*\.db$")
+    shards = {}
+    if os.path.isdir(output_directory):
+        for entry in os.scandir(output_directory):
+            match = pattern.match(entry.name)
+            if match and entry.is_file():
+                shards.setdefault(int(match.group(1)), []).append(entry.path)
+    return shards
+
+
+def _remove_shard(shard_name: str):
+    """Delete a shard file with its WAL files."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(shard_name + suffix):
+            os.remove(shard_name + suffix)
+    _notify_change(shard_name)
+
+
+def rebuild_book_shard(db_name: str, book_id: int, output_directory: str = None):
+    """Rebuild the shard of one book from scratch, returns its path.
+
+    Returns None and removes the old shard when the book is no longer in the source.
+    """
+    if not os.path.exists(db_name):
+        raise FileNotFoundError(db_name)
+    require_current_schema(db_name)  # Splitting only reads the source, it never migrates it
+    output_directory = _shard_directory(db_name, output_directory)
+
+    book = get_book(db_name, int(book_id))
+    shard_name = None
+    if book:
+        base_name = os.path.splitext(os.path.basename(db_name))[0]
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.splitext(book[3])[0])
+        shard_name = os.path.join(output_directory, f"{base_name}_{book[0]}_{safe_name}.db")
+
+    for stale in _existing_shards(db_name, output_directory).get(int(book_id), []):
+        if stale != shard_name:
+            _remove_shard(stale)
+    if shard_name is None:
+        return None
+
+    if os.path.exists(shard_name) and get_schema_version(shard_name) != SCHEMA_VERSION:
+        _remove_shard(shard_name)
+    os.makedirs(output_directory, exist_ok=True)
+    create_database(shard_name)
+
+    conn = sqlite3.connect(shard_name, isolation_level=None)
+    cursor = conn.cursor()
+    cursor.execute("ATTACH DATABASE ? AS source", (db_name,))
+
+    # Emptied and refilled in one transaction, so a search of the shard sees the old copy or the new one, never half
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("DELETE FROM page_embeddings")
+    cursor.execute("DELETE FROM pages")
+    cursor.execute("DELETE FROM books")
+
+    # Keep the original ids so results from every shard still point at the same book
+    cursor.execute("INSERT INTO books SELECT * FROM source.books WHERE id = ?", (book[0],))
+    cursor.execute("INSERT INTO pages SELECT * FROM source.pages WHERE book_id = ?", (book[0],))
+    cursor.execute('''
+    INSERT INTO page_embeddings
+    SELECT e.* FROM source.page_embeddings e
+    JOIN source.pages p ON p.id = e.page_id
+    WHERE p.book_id = ?
+    ''', (book[0],))
+    cursor.execute("COMMIT")
+
+    cursor.execute("DETACH DATABASE source")
+    conn.close()
+    _notify_change(shard_name)
+    incremental_vacuum_in_background(shard_name)
+    return shard_name
+
+
+def split_database_by_book(db_name: str, output_directory: str = None):
+    """Split a database into one shard database per book so each shard can be searched and rebuilt on its own.
+
+    Shards go to a "<db name>_shards" folder next to the source by default, never beside it,
+    so searching the source's folder doesn't return every page twice. Every shard is rebuilt,
+    and shards of books that were removed or replaced (a replaced book gets a new id) are deleted.
+    """
+    if not os.path.exists(db_name):
+        raise FileNotFoundError(db_name)
+    require_current_schema(db_name)
+    output_directory = _shard_directory(db_name, output_directory)
+
+    books = list_books(db_name)
+    book_ids = {book[0] for book in books}
+    for book_id, shard_names in _existing_shards(db_name, output_directory).items():
+        if book_id not in book_ids:
+            for shard_name in shard_names:
+                _remove_shard(shard_name)
+
+    return [rebuild_book_shard(db_name, book[0], output_directory) for book in books]
+
+
+if __name__ == "__main__":
+    # Migration tool: python database_commands.py <db_name> [<db_name> ...] [--compress]
+    compress = True if "--compress" in sys.argv[1:] else None
+    for db_name in [arg for arg in sys.argv[1:] if arg != "--compress"]:
+        print(f"{db_name}: schema version {get_schema_version(db_name)}")
+        migrate_database(db_name, compress)
+        print(f"{db_name}: schema version {get_schema_version(db_name)}")
@@ -4,10 +4,27 @@ import database_commands
 import json
 import tiktoken
 
+# Memory compaction defaults: past this many tokens, older turns are folded into a running summary
+MEMORY_COMPACT_THRESHOLD = 4096
+MEMORY_KEEP_RECENT = 4  # Turns always kept verbatim
+
+
+def add_complete_book(db_name: str, pdf_path: str, url_of_api: str, model_name: str, start_page: int = 0, stop_page: int = None, progress_callback=None, compress: bool = None, replace_existing: bool = False):
+    """Extracts, processes, and adds a complete book to the database.
+
+    progress_callback(stage, done, total) is called as pages are embedded and stored.
+    compress stores page text zlib-compressed, None follows database_commands.COMPRESS_PAGE_TEXT.
+    Files whose content hash is already stored are skipped.
+    replace_existing swaps out an older book with the same file name, once the new version is fully stored.
+    """
+    book_name = SearchDataEmbed.os.path.basename(pdf_path)  # Use filename as book name
+
+    # Step 0: Create or upgrade the database and skip content that is already in it
+    database_commands.create_database(db_name)
+    content_hash = Vector_v2.file_content_hash(pdf_path)
+    if database_commands.get_book_by_hash(db_name, content_hash):
+        return f"{book_name} is already in the database."
 
-def add_complete_book(db_name: str, pdf_path: str, url_of_api: str, model_name: str, start_page: int = 0, stop_page: int = None):
-    """Extracts, processes, and adds a complete book to the database."""
-    
     # Step 1: Extract text from the PDF
     pages = Vector_v2.open_and_read_pdf(pdf_path,start_page,stop_page)
 
@@ -15,21 +32,42 @@ def add_complete_book(db_name: str, pdf_path: str, url_of_api: str, model_name:
         return "No pages extracted from the PDF."
 
     # Step 2: Generate embeddings
-    pages = Vector_v2.get_text_vectors(pages, url_of_api, model_name)
+    embed_progress = (lambda done, total: progress_callback("embedding", done, total)) if progress_callback else None
+    pages = Vector_v2.get_text_vectors(pages, url_of_api, model_name, embed_progress)
 
-    # Step 3: Add the book to the database
-    book_name = SearchDataEmbed.os.path.basename(pdf_path)  # Use filename as book name
-    database_commands.add_book(db_name, book_name, book_name)
+    # Nothing is stored (not even the content hash) unless every page got an embedding, so the file is retried later
+    failed_pages = [page["page_number"] for page in pages if page.get("embedding") is None or len(page["embedding"]) == 0]
+    if failed_pages:
+        raise RuntimeError(f"Embedding failed for {len(failed_pages)} of {len(pages)} pages of {book_name} (first: page {failed_pages[0]}).")
+
+    # Step 3: Add the book to the database, next to the old version when replacing it
+    old_book = database_commands.get_book(db_name, book_name) if replace_existing else None
+    book_id = database_commands.add_book(db_name, book_name, book_name, content_hash, allow_duplicate=old_book is not None)
+    created = book_id is not None
+    if not created:
+        book_id = database_commands.get_book(db_name, book_name)[0]
 
     # Step 4: Store pages in the database
-    for page in pages:
-        database_commands.add_page(db_name, page)
+    try:
+        for done, page in enumerate(pages, start=1):
+            page["book_id"] = book_id
+            database_commands.add_page(db_name, page, compress)
+            if progress_callback:
+                progress_callback("storing", done, len(pages))
+    except Exception:
+        if created:
+            database_commands.remove_book(db_name, book_id)  # Drop the half-stored book and its content hash, the old version stays
+        raise
+
+    # Step 5: Drop the old version only now that the new one is complete
+    if old_book:
+        database_commands.remove_book(db_name, old_book[0])
 
     return f"Successfully added {book_name} with {len(pages)} pages."
 
 
 def list_models(url_of_api:str):
-    response = Vector_v2.requests.get(url_of_api)
+    response = Vector_v2.session.get(url_of_api)
     if response.status_code == 200:
         # Parse the response JSON
         models_data = response.json()
@@ -42,20 +80,118 @@ def list_models(url_of_api:str):
         return(f"Failed to retrieve models. Status code: {response.status_code}")
     
 def count_tokens(data_list, model="gpt-3.5-turbo"):
-    """Counts the total number of tokens in an array of dictionaries containing 'query' and 'response' keys."""
+    """Counts the total number of tokens in an array of dictionaries containing 'query', 'response' or 'summary' keys."""
     enc = tiktoken.encoding_for_model(model)
     
     total_tokens = 0
     for data in data_list:
         if isinstance(data, dict):  # Ensure it's a dictionary
-            for key in ['query', 'response']:  # Process only 'query' and 'response' keys
+            for key in ['query', 'response', 'summary']:  # Process only conversation keys
                 if key in data and isinstance(data[key], str):  
                     total_tokens += len(enc.encode(data[key]))
     
     return total_tokens
 
 
-def query_ai_system(url_of_api:str, query:str, model:str,rag_items = [], memory=[]):
+def format_memory(memory):
+    """Formats memory for a prompt, a running summary (if any) comes first, then the verbatim turns."""
+    if not memory:
+        return "No prior memory."
+
+    return "\n\n".join(
+        [f"Summary of earlier conversation:\n{mem['summary']}" if 'summary' in mem
+         else f"Query: {mem['query']}\nResponse: {mem['response']}" for mem in memory]
+    )
+
+
+def fit_memory_to_budget(memory, max_tokens: int, model="gpt-3.5-turbo"):
+    """Keeps the summary and as many of the most recent turns as fit in max_tokens.
+
+    Tokens are counted on format_memory's output, so headers and separators are included.
+    """
+    if max_tokens <= 0 or not memory:
+        return []
+
+    enc = tiktoken.encoding_for_model(model)
+    count = lambda text: len(enc.encode(text))
+    summary = [mem for mem in memory if 'summary' in mem][:1]
+    turns = [mem for mem in memory if 'summary' not in mem]
+
+    # A summary that alone is over budget is cut down (oldest part first) rather than dropped
+    if summary and count(format_memory(summary)) > max_tokens:
+        summary_tokens = enc.encode(summary[0]['summary'])
+        keep = max_tokens - count(format_memory([{"summary": ""}]))
+        while keep > 0 and count(format_memory([{"summary": enc.decode(summary_tokens[-keep:])}])) > max_tokens:
+            keep -= 1
+        return [{"summary": enc.decode(summary_tokens[-keep:])}] if keep > 0 else []
+
+    # Each entry is encoded once, with the separator that joins it to the next
+    separator = count("\n\n")
+    remaining = max_tokens - (count(format_memory(summary)) + separator if summary else 0)
+    kept = []
+    for turn in reversed(turns):
+        cost = count(format_memory([turn])) + (separator if kept else 0)
+        if cost > remaining:
+            break
+        kept.append(turn)
+        remaining -= cost
+    fitted = summary + kept[::-1]
+
+    # Tokens can merge across entry boundaries, one check on the whole text keeps the bound exact
+    while len(fitted) > len(summary) and count(format_memory(fitted)) > max_tokens:
+        del fitted[len(summary)]
+    return fitted
+
+
+def summarize_turns(url_of_api: str, model: str, turns: list, previous_summary: str = None):
+    """Asks the model to fold conversation turns into a running summary, returns None on failure."""
+    conversation = "\n\n".join(f"Query: {turn['query']}\nResponse: {turn['response']}" for turn in turns)
+    prompt = f"""
+Update the running summary of a conversation between a user and an assistant.
+Keep names, facts, decisions and open questions. Drop small talk and repetition. Be concise.
+
+### Current Summary:
+{previous_summary or "None yet."}
+
+### New Turns:
+{conversation}
+
+### Updated Summary:
+"""
+
+    payload = {"model": model, "prompt": prompt, "stream": False}
+    headers = {"Content-Type": "application/json"}
+    response = Vector_v2.session.post(url_of_api, data=json.dumps(payload), headers=headers)
+
+    if response.status_code == 200:
+        return response.json().get("response") or None
+    return None
+
+
+def compact_memory(url_of_api: str, model: str, memory: list, keep_recent: int = MEMORY_KEEP_RECENT, threshold_tokens: int = MEMORY_COMPACT_THRESHOLD):
+    """Returns memory with all but the last keep_recent turns folded into the running summary once it is over threshold_tokens.
+
+    The input list is not modified, so this can run in the background on a snapshot.
+    """
+    summary = next((mem['summary'] for mem in memory if 'summary' in mem), None)
+    turns = [mem for mem in memory if 'summary' not in mem]
+
+    if count_tokens(memory) <= threshold_tokens or len(turns) <= keep_recent:
+        return list(memory)
+
+    old_turns, recent_turns = turns[:len(turns) - keep_recent], turns[len(turns) - keep_recent:]
+    new_summary = summarize_turns(url_of_api, model, old_turns, summary)
+    if new_summary is None:
+        return list(memory)  # Keep everything and try again after the next request
+
+    return [{"summary": new_summary}] + recent_turns
+
+
+def query_ai_system(url_of_api:str, query:str, model:str,rag_items = [], memory=[], max_prompt_tokens: int = None):
+    """Answers the query with the retrieved context and memory.
+
+    When max_prompt_tokens is set, memory is trimmed (summary first, then newest turns) so the prompt stays under it.
+    """
     # Format the retrieved context
 
 
@@ -65,10 +201,45 @@ def query_ai_system(url_of_api:str, query:str, model:str,rag_items = [], memory=
 
 
 
-    formatted_memory = "\n\n".join(
-        [f"Query: {mem['query']}\nResponse: {mem['response']}" for mem in memory]
-    ) if memory else "No prior memory."
+    prompt_memory = memory
+    if max_prompt_tokens is not None:
+        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        base_tokens = len(enc.encode(build_prompt(query, formatted_context, "")))
+        memory_budget = max_prompt_tokens - base_tokens
+        prompt_memory = fit_memory_to_budget(memory, memory_budget)
+
+        # Check the finished prompt too, tokens can merge where memory meets the template.
+        # Refitting to a smaller budget drops the oldest turns before it cuts into the summary.
+        while prompt_memory:
+            overflow = len(enc.encode(build_prompt(query, formatted_context, format_memory(prompt_memory)))) - max_prompt_tokens
+            if overflow <= 0:
+                break
+            memory_budget -= overflow
+            prompt_memory = fit_memory_to_budget(memory, memory_budget)
+    formatted_memory = format_memory(prompt_memory)
 
+    prompt = build_prompt(query, formatted_context, formatted_memory)
+
+    # API Request to Ollama
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": False  # Change to True if you want a streaming response
+    }
+
+    headers = {"Content-Type": "application/json"}
+    response = Vector_v2.session.post(url_of_api, data=json.dumps(payload), headers=headers)
+
+    if response.status_code == 200:
+        response_text = response.json().get("response", "No response received.")
+        memory.append({"query": query, "response": response_text})  # Store query-response pair in memory
+        return response_text, memory
+    else:
+        return f"Error: {response.status_code} - {response.text}", memory
+
+
+def build_prompt(query: str, formatted_context: str, formatted_memory: str):
+    """Builds the structured prompt sent to the model."""
     # Define the structured prompt
     prompt = f"""
 You are a helpful assistant that retrieves relevant information but explains it in a natural, engaging way.
@@ -94,29 +265,17 @@ Now, craft a response that is helpful and natural.
 
 ### Response:
 """
-
-    # API Request to Ollama
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False  # Change to True if you want a streaming response
-    }
-
-    headers = {"Content-Type": "application/json"}
-    response = Vector_v2.requests.post(url_of_api, data=json.dumps(payload), headers=headers)
-
-    if response.status_code == 200:
-        response_text = response.json().get("response", "No response received.")
-        memory.append({"query": query, "response": response_text})  # Store query-response pair in memory
-        return response_text, memory
-    else:
-        return f"Error: {response.status_code} - {response.text}", memory
+    return prompt
 
 def list_dbs(directory="."):
     """Lists all .db files in the specified directory."""
     return [f for f in SearchDataEmbed.os.listdir(directory) if f.endswith(".db")]
 
 
+def search_all_dbs(query: str, url_of_api: str, model_name: str, directory=".", top_n: int = 10, focus_only: bool = False):
+    """Searches every .db file in the directory in parallel and returns the global top N page texts.
 
-
-
+    Shards made by database_commands.split_database_by_book live in their own folder, pass it as directory to search them.
+    """
+    db_names = [SearchDataEmbed.os.path.join(directory, f) for f in list_dbs(directory)]
+    return SearchDataEmbed.federated_search_and_return_results(db_names, query, url_of_api, model_name, top_n, focus_only)